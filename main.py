@@ -1,12 +1,19 @@
 import asyncio
 import aiohttp
-import requests
 import streamlit as st
 import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Try importing Gemini
 try:
     import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
     GEMINI_AVAILABLE = True
 except ImportError:      
     GEMINI_AVAILABLE = False
@@ -28,14 +35,15 @@ st.set_page_config(
 # Method 1: Streamlit Secrets (for Streamlit Cloud deployment)
 # Method 2: Environment Variables (for local development)
 
+@st.cache_data(show_spinner=False)
 def get_api_key(key_name, secret_name):
     """Get API key from Streamlit secrets or environment variables"""
-    try:
-        # Try Streamlit secrets first (for cloud deployment)
+    # Try Streamlit secrets first (for cloud deployment); checking the file
+    # exists first avoids raising when there is no secrets.toml
+    if st.secrets.load_if_toml_exists() and secret_name in st.secrets:
         return st.secrets[secret_name]
-    except:
-        # Fall back to environment variables (for local development)
-        return os.getenv(key_name, "")
+    # Fall back to environment variables (for local development)
+    return os.getenv(key_name, "")
 
 GEMINI_API_KEY = get_api_key("GEMINI_API_KEY", "GEMINI_API_KEY")
 SERPER_KEY = get_api_key("SERPER_KEY", "SERPER_KEY")
@@ -66,13 +74,13 @@ def setup_gemini():
             "models/gemini-flash-latest",
             "models/gemini-pro-latest"
         ]:
+            # Metadata lookup only; no tokens are generated to probe the model
             try:
-                model = genai.GenerativeModel(model_name)
-                test = model.generate_content("hello", generation_config={"max_output_tokens": 5})
-                if test and test.text:
-                    return model_name, True
-            except Exception as e:
+                model_info = genai.get_model(model_name)
+            except google_exceptions.NotFound:
                 continue
+            if "generateContent" in model_info.supported_generation_methods:
+                return model_name, True
         return None, False
     except Exception as e:
         st.error(f"❌ Gemini setup failed: {e}")
@@ -83,83 +91,281 @@ WORKING_MODEL, gemini_ready = setup_gemini()
 # -------------------------
 # API CONFIGS
 # -------------------------
+# Static instructions, sent once as the model's system instruction
+SYSTEM_PROMPT = """You are a friendly, expert AI shopping assistant.
+Use your own knowledge and, where useful, the context given with the query.
+- Give a detailed, natural, conversational answer.
+- Include technical details and comparisons where relevant.
+- Write like an expert human reviewer.
+- Structure the answer with headers, bullet points, and a clear conclusion.
+- Don't say "here's what I found"; just answer directly.
+- Be friendly and professional."""
+
+# Per-snippet cap on search context sent to Gemini
+SNIPPET_MAX_CHARS = 200
+
+# Whole-word match, so "shirt" or "which" no longer count as greetings
+GREETING_RE = re.compile(r"\b(hi+|hello|hey|good (morning|evening|afternoon))\b", re.I)
+
+# Coalesce streamed chunks into fewer UI renders
+STREAM_FLUSH_CHUNKS = 5
+STREAM_FLUSH_SECONDS = 0.05
+
+# Total time allowed for each Serper/AliExpress request
+UPSTREAM_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# How long Serper/AliExpress results are reused
+UPSTREAM_CACHE_SECONDS = 3600
+
+# Upstream statuses worth retrying; auth errors (401/403) are never retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 ALIEXPRESS_HEADERS = {
     "X-RapidAPI-Key": ALIEXPRESS_KEY,
     "X-RapidAPI-Host": "aliexpress-datahub.p.rapidapi.com"
 }
 
-async def fetch_aliexpress(query):
+# -------------------------
+# Shared HTTP client
+# -------------------------
+@st.cache_resource
+def get_event_loop():
+    """Background event loop shared across reruns so pooled connections stay usable"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def _create_http_session():
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector)
+
+@st.cache_resource
+def get_http_session():
+    """One pooled aiohttp session, reused so keep-alive skips repeat TCP/TLS handshakes"""
+    return run_async(_create_http_session())
+
+async def fetch_aliexpress(session, query):
     if not ALIEXPRESS_KEY:
         return None
     url = "https://aliexpress-datahub.p.rapidapi.com/search"
     params = {"query": query, "limit": "8"}
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=ALIEXPRESS_HEADERS, params=params, timeout=10) as resp:
-                if resp.status != 200:
-                    return None
-                data = await resp.json()
-                return [
-                    {"title": i.get("title", ""), "price": i.get("price", "N/A"), "rating": i.get("rating", "N/A")}
-                    for i in data.get("results", [])
-                ]
-    except Exception as e:
-        st.error(f"AliExpress Error: {e}")
-        return None
+    async with session.get(url, headers=ALIEXPRESS_HEADERS, params=params, timeout=UPSTREAM_TIMEOUT) as resp:
+        # Raise rather than return None so a failed call is never cached
+        resp.raise_for_status()
+        data = await resp.json()
+        return [
+            {"title": i.get("title", ""), "price": i.get("price", "N/A"), "rating": i.get("rating", "N/A")}
+            for i in data.get("results", [])
+        ]
 
-def fetch_serper_data(query):
+async def fetch_serper_data(session, query):
     if not SERPER_KEY:
         return None
     url = "https://google.serper.dev/search"
     headers = {"X-API-KEY": SERPER_KEY, "Content-Type": "application/json"}
     payload = {"q": query, "num": 10}
+    async with session.post(url, headers=headers, json=payload, timeout=UPSTREAM_TIMEOUT) as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+async def retry(coro_fn, tries=3, base=0.2, cap=2.0):
+    """Retry transient upstream failures with exponential backoff and full jitter"""
+    for attempt in range(tries):
+        try:
+            return await coro_fn()
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES or attempt == tries - 1:
+                raise
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            # Includes ServerDisconnectedError, seen when a pooled keep-alive
+            # connection is closed by the server just as it is reused
+            if attempt == tries - 1:
+                raise
+        # asyncio.sleep, not time.sleep, so the shared loop keeps serving other lookups
+        await asyncio.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+# -------------------------
+# Circuit breakers
+# -------------------------
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open"""
+
+class CircuitBreaker:
+    """Fast-fails calls to a provider after repeated failures.
+
+    CLOSED until fail_threshold consecutive failures, then OPEN for
+    recovery seconds, then HALF_OPEN: one trial call decides whether to
+    close again or reopen. A trial that never reports back is dropped
+    after another recovery period so the circuit can't stick open.
+    """
+
+    def __init__(self, fail_threshold=5, recovery=30.0):
+        self.fail_threshold = fail_threshold
+        self.recovery = recovery
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if self.trial_started_at is not None:
+                if now - self.trial_started_at < self.recovery:
+                    return False
+            elif now - self.opened_at < self.recovery:
+                return False
+            self.trial_started_at = now
+            return True
+
+    def release(self):
+        """End a trial call that neither succeeded nor failed"""
+        with self._lock:
+            self.trial_started_at = None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_started_at = None
+            if self.failures >= self.fail_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+@st.cache_resource
+def get_circuit_breaker(provider):
+    """One breaker per provider, shared across reruns and sessions"""
+    return CircuitBreaker()
+
+async def _create_semaphore(limit):
+    return asyncio.Semaphore(limit)
+
+@st.cache_resource
+def get_bulkhead(provider, limit=4):
+    """Caps in-flight calls per provider so bursts queue instead of swarming upstream"""
+    # Created on the shared loop, which is where it will be awaited
+    return run_async(_create_semaphore(limit))
+
+async def bounded(semaphore, coro_fn):
+    async with semaphore:
+        return await coro_fn()
+
+def call_upstream(provider, coro_fn):
+    """Run a fetch coroutine with retries, guarded by the provider's breaker and bulkhead"""
+    breaker = get_circuit_breaker(provider)
+    if not breaker.allow():
+        raise CircuitOpenError(provider)
     try:
-        res = requests.post(url, headers=headers, json=payload, timeout=10)
-        if res.status_code != 200:
-            return None
-        return res.json()
-    except Exception as e:
-        st.error(f"Serper Error: {e}")
-        return None
+        # Each attempt takes a slot, so backoff sleeps don't hold one
+        result = run_async(retry(partial(bounded, get_bulkhead(provider), coro_fn)))
+    except Exception:
+        breaker.record_failure()
+        raise
+    finally:
+        breaker.release()
+    breaker.record_success()
+    return result
+
+# cache_key is the normalized query; _query (unhashed) keeps the user's casing
+# so the upstream search sees product names as typed
+@st.cache_data(ttl=UPSTREAM_CACHE_SECONDS, max_entries=1000, show_spinner=False)
+def cached_serper(cache_key, _query):
+    return call_upstream("serper", partial(fetch_serper_data, get_http_session(), _query))
+
+@st.cache_data(ttl=UPSTREAM_CACHE_SECONDS, max_entries=1000, show_spinner=False)
+def cached_aliexpress(cache_key, _query):
+    return call_upstream("aliexpress", partial(fetch_aliexpress, get_http_session(), _query))
+
+def normalize_query(query):
+    """Collapse case and whitespace so equivalent queries share a cache entry"""
+    return " ".join(query.lower().split())
+
+def fetch_context(query):
+    """Fetch search context; a failed lookup just means less context, not a failed answer"""
+    cache_key = normalize_query(query)
+    ctx = get_script_run_ctx()
+
+    def lookup(fetch):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return fetch(cache_key, query)
+        except Exception as e:
+            return e
+
+    # Both lookups run at once so a cold cache still costs only the slower one
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        serper_data, aliexpress_data = pool.map(lookup, [cached_serper, cached_aliexpress])
+
+    # An open circuit just skips that provider's context without an error
+    if isinstance(serper_data, Exception):
+        if not isinstance(serper_data, CircuitOpenError):
+            st.error(f"Serper Error: {serper_data}")
+        serper_data = None
+    if isinstance(aliexpress_data, Exception):
+        if not isinstance(aliexpress_data, CircuitOpenError):
+            st.error(f"AliExpress Error: {aliexpress_data}")
+        aliexpress_data = None
+    return serper_data, aliexpress_data
 
 # -------------------------
 # Natural AI Response Generator
 # -------------------------
-def generate_ai_response(user_query, serper_data=None):
-    """Gemini generates full conversational, natural answers."""
+@st.cache_resource
+def get_gemini_model(model_name):
+    """Build the Gemini model once and reuse it for every message"""
+    return genai.GenerativeModel(model_name, system_instruction=SYSTEM_PROMPT)
+
+def with_notice(text, notice):
+    """Keep any text already streamed and append the notice after it"""
+    if text:
+        return f"{text}\n\n{notice}"
+    return notice
+
+def generate_ai_response(user_query, serper_data=None, aliexpress_data=None, placeholder=None):
+    """Gemini generates full conversational, natural answers, streamed into placeholder."""
     if not gemini_ready or not WORKING_MODEL:
         return (
             "I'm currently running in fallback mode — "
             "please check the Gemini API key or internet connection."
         )
 
-    context_info = ""
+    context_lines = []
     if serper_data:
         organic = serper_data.get("organic", [])
-        snippets = [o.get("snippet", "") for o in organic[:3]]
-        context_info = "\n".join(snippets)
+        context_lines += [(o.get("snippet") or "")[:SNIPPET_MAX_CHARS] for o in organic[:3]]
+    if aliexpress_data:
+        context_lines += [
+            f"AliExpress: {(p['title'] or '')[:SNIPPET_MAX_CHARS]} | Price: {p['price']} | Rating: {p['rating']}"
+            for p in aliexpress_data[:5]
+        ]
+    prompt = f"Query: {user_query}\nContext:\n" + "\n".join(context_lines)
 
-    prompt = f"""
-You are a friendly, expert AI shopping assistant.
+    # generate_content blocks until the first chunk, so show progress until then.
+    # Rendered before allow(): Streamlit calls can raise a rerun, and nothing may
+    # run between allow() and the try that releases the trial.
+    if placeholder is not None:
+        placeholder.markdown("⏳ Thinking...")
 
-User asked: "{user_query}"
-
-Use your own knowledge and optionally the following info if useful:
-{context_info}
-
-Your task:
-- Provide a detailed, natural, and conversational answer.
-- Include technical details and comparisons where relevant.
-- Write like an expert human reviewer (like ChatGPT style).
-- Structure the response with headers, bullet points, and a clear conclusion.
-- Avoid saying "here's what I found"; just answer directly.
-- Be friendly and professional.
-"""
+    breaker = get_circuit_breaker("gemini")
+    if not breaker.allow():
+        return "⚠️ Gemini is temporarily unavailable. Please try again in a moment."
 
+    text = ""
     try:
-        model = genai.GenerativeModel(WORKING_MODEL)
-        res = model.generate_content(
+        model = get_gemini_model(WORKING_MODEL)
+        stream = model.generate_content(
             prompt,
+            stream=True,
             generation_config={
                 "temperature": 0.7,
                 "max_output_tokens": 2048,
@@ -167,11 +373,34 @@ Your task:
                 "top_k": 40,
             },
         )
-        if res and res.text:
-            return res.text
+        pending = 0
+        last_flush = None
+        for chunk in stream:
+            text += chunk.text
+            pending += 1
+            now = time.monotonic()
+            # The first chunk renders right away to replace the thinking notice
+            if placeholder is not None and (
+                last_flush is None
+                or pending >= STREAM_FLUSH_CHUNKS
+                or now - last_flush >= STREAM_FLUSH_SECONDS
+            ):
+                placeholder.markdown(text)
+                pending = 0
+                last_flush = now
+        breaker.record_success()
+        if text:
+            return text
         return "⚠️ Gemini returned no response."
+    except (google_exceptions.GoogleAPIError, ConnectionError, TimeoutError) as e:
+        breaker.record_failure()
+        return with_notice(text, f"⚠️ Error connecting to Gemini API: {str(e)}")
     except Exception as e:
-        return f"⚠️ Error connecting to Gemini API: {str(e)}"
+        # Content errors (e.g. a safety-blocked chunk) don't mean Gemini is down
+        return with_notice(text, f"⚠️ Gemini couldn't complete the response: {str(e)}")
+    finally:
+        # Also runs on Streamlit's rerun/stop exceptions, so a trial is never leaked
+        breaker.release()
 
 # -------------------------
 # STREAMLIT UI
@@ -230,26 +459,27 @@ if prompt := st.chat_input("What would you like to know?"):
     
     # Generate assistant response
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            user_input = prompt.strip().lower()
-            
-            # Handle greetings
-            greetings = ["hi", "hii", "hello", "hey", "good morning", "good evening", "good afternoon"]
-            if any(word in user_input for word in greetings):
-                response = (
-                    "👋 Hello there! I'm your AI Shopping Assistant. "
-                    "I can help you compare products, find deals, or learn specs. "
-                    "What would you like to explore today?"
-                )
-            else:
-                # Fetch data and generate response
-                try:
-                    serper_data = fetch_serper_data(user_input)
-                    response = generate_ai_response(user_input, serper_data)
-                except Exception as e:
-                    response = f"⚠️ An error occurred: {str(e)}"
-            
-            st.markdown(response)
+        placeholder = st.empty()
+        # Keep the original casing so brand and model names reach Serper and Gemini intact
+        user_input = prompt.strip()
+        
+        # Handle greetings
+        if GREETING_RE.search(prompt):
+            response = (
+                "👋 Hello there! I'm your AI Shopping Assistant. "
+                "I can help you compare products, find deals, or learn specs. "
+                "What would you like to explore today?"
+            )
+        else:
+            # Fetch data and stream the response as it is generated
+            try:
+                with st.spinner("Thinking..."):
+                    serper_data, aliexpress_data = fetch_context(user_input)
+                response = generate_ai_response(user_input, serper_data, aliexpress_data, placeholder)
+            except Exception as e:
+                response = f"⚠️ An error occurred: {str(e)}"
+        
+        placeholder.markdown(response)
     
     # Add assistant response to chat history
     st.session_state.messages.append({"role": "assistant", "content": response})